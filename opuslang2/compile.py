@@ -1,21 +1,24 @@
 from __future__ import annotations
 
-import prettyprinter
-prettyprinter.install_extras(['dataclasses'])
-
-from copy import deepcopy
-from functools import partial, reduce
-from typing import Optional, Any, List
+import sys
+from functools import partial, lru_cache
+from typing import Optional, Any, List, Dict, Tuple
 
 from opuslang2.parser import parser
-from lark import Transformer, v_args
+from lark import v_args
+from lark.visitors import Transformer_InPlace
 import lark
 from opus.lang import ir
 from dataclasses import dataclass, field
 
-import random
+# slots=True is only accepted by dataclass from python 3.10 on
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# Suit of point atoms, shared by every point condition. Carries no position info
+_POINTS_SUIT = ir.Suit(None, "@")
 
-@dataclass(frozen=True, order=True)
+
+@dataclass(frozen=True, order=True, **_SLOTS)
 class Bid:
     level: int
     color: ir.Suit
@@ -28,53 +31,60 @@ class Bid:
         return Bid(level, suit, None)
 
 
-def _is_prefix(p, l):
-    for prefix_el, list_el in zip(p, l):
-        if prefix_el != list_el:
-            return False
-    return True
+@lru_cache(maxsize=256)
+def _parse_bid_sequence(s: str) -> Tuple[Bid, ...]:
+    # Bids are immutable, so parsed sequences can be shared between histories
+    return tuple(map(Bid.from_str, s.split("-")))
+
 
+def _is_prefix(p, l: Tuple) -> bool:
+    # tuple() is a no-op on tuples, other sequences have to match l's type for ==
+    return l[:len(p)] == tuple(p)
 
-@dataclass
+
+@dataclass(frozen=True, **_SLOTS)
 class BidHistory:
-    sequence: List[Bid]
-    meta: Optional[Any] = field(repr=False, default=None)
+    sequence: Tuple[Bid, ...]
+    meta: Optional[Any] = field(repr=False, compare=False, default=None)
 
     def __contains__(self, item):
-        if isinstance(item, BidHistory):
-            item = item.sequence
         if isinstance(item, str):
-            item = BidHistory.from_str(item).sequence
+            item = _parse_bid_sequence(item)
+        elif isinstance(item, BidHistory):
+            item = item.sequence
 
         return _is_prefix(item, self.sequence)
 
     def __add__(self, other):
         if isinstance(other, Bid):
-            new_sequence = self.sequence.copy()
-            new_sequence.append(other)
-            return BidHistory(new_sequence, self.meta)
+            return BidHistory(self.sequence + (other,), self.meta)
         else:
             raise ValueError(f"Add operator between BidHistory and {type(other)} not supported")
 
     @classmethod
     def from_str(cls, s: str) -> BidHistory:
-        return BidHistory(list(map(Bid.from_str, s.split("-"))), None)
+        return BidHistory(_parse_bid_sequence(s), None)
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class BidExpression:
     prefix: Bid
     conditions: List[Condition]
     meta: Optional[Any] = field(repr=False)
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Branch:
     prefix: BidHistory
     continuations: List[BidExpression]
     meta: Optional[Any] = field(repr=False)
+    # Filled on first all_conditions_sorted() call, continuations are not expected to change afterwards
+    _sorted: Optional[List[Tuple[Condition, Bid]]] = field(default=None, init=False, repr=False, compare=False)
 
     def all_conditions_sorted(self):
+        if self._sorted is not None:
+            return iter(self._sorted)
+
         to_sort = []
         for bid_expr in self.continuations:
             for cond in bid_expr.conditions:
@@ -83,16 +93,15 @@ class Branch:
                 # Suit compare can't be flipped, so we flip the priority order, then reverse whole list
                 num_val = -cond.priority if cond.priority is not None else -999_999
 
-                # Comparison between conditions is undefined
-                # To work around it we add a random uniquifier to comparing tuple
-
-                uniquifier = random.randrange(999999999999)
-                to_sort.append((num_val, bid_expr.prefix, uniquifier, cond))
-        to_sort.sort(reverse=True)
-        return ((c, bid) for _, bid, _,  c in to_sort)
+                # Comparison between conditions is undefined, so they are left out of the sort key
+                # Sort is stable (also when reversed), ties keep their order from the source
+                to_sort.append((num_val, bid_expr.prefix, cond))
+        to_sort.sort(key=lambda t: (t[0], t[1]), reverse=True)
+        self._sorted = [(c, bid) for _, bid, c in to_sort]
+        return iter(self._sorted)
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class LogicSuit:
     type: str
     lhs: ir.Suit
@@ -110,26 +119,23 @@ class LogicSuit:
         if isinstance(expr.rhs, LogicSuit) and isinstance(expr.lhs, LogicSuit):
             raise NotImplementedError("Only one side of expression can be a logic suit")
 
+        # Variants differ from expr only in the replaced side, so no copying is needed
         if isinstance(logic_suit := getattr(expr.lhs, "child", None), LogicSuit):
-            variant1 = deepcopy(expr)
-            variant2 = deepcopy(expr)
-            variant1.lhs = logic_suit.lhs
-            variant2.lhs = logic_suit.rhs
+            variant1 = ir.BinaryExpr(expr.meta, logic_suit.lhs, expr.op, expr.rhs)
+            variant2 = ir.BinaryExpr(expr.meta, logic_suit.rhs, expr.op, expr.rhs)
 
             return ir.BinaryExpr(expr.meta, variant1, logic_suit.type, variant2)
 
-        elif isinstance(getattr(expr.rhs, "child", None), LogicSuit):
-            variant1 = deepcopy(expr)
-            variant2 = deepcopy(expr)
-            variant1.lhs = logic_suit.lhs
-            variant2.lhs = logic_suit.rhs
+        elif isinstance(logic_suit := getattr(expr.rhs, "child", None), LogicSuit):
+            variant1 = ir.BinaryExpr(expr.meta, expr.lhs, expr.op, logic_suit.lhs)
+            variant2 = ir.BinaryExpr(expr.meta, expr.lhs, expr.op, logic_suit.rhs)
 
             return ir.BinaryExpr(expr.meta, variant1, logic_suit.type, variant2)
         else:
             return expr
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Condition:
     expr: Any
     priority: Optional[int]  # None means no priority == infinity
@@ -139,31 +145,25 @@ class Condition:
         return ir.one_shot_gen(self.expr)
 
 
-def meta_kw(func):
-    def f(meta, *args, **kwargs):
-        return func(*args, meta=meta, **kwargs)
-
-    return f
-
-
+# meta=True passes meta as the first positional argument, before the inlined children
+# Transformer_InPlace is iterative (unlike Transformer) and calls token callbacks on every lark
+# version we support (unlike Transformer_NonRecursive before 0.12). It consumes the parse tree
 @v_args(inline=True, meta=True)
-class CompileTransformer(Transformer):
+class CompileTransformer(Transformer_InPlace):
 
     @staticmethod
-    @meta_kw
-    def point_range(range_gen, color=None, meta=None):
+    def point_range(meta, range_gen, color=None):
         if color is not None:
             raise NotImplementedError("Colored ranges not supported")
 
         # Now we can assume child is an ir.Expr for points
-        return range_gen(ir.Atom("SUIT_POINTS", meta, ir.Suit(meta, "@")))
+        return range_gen(ir.Atom("SUIT_POINTS", meta, _POINTS_SUIT))
 
     # range methods return functions
     # arguments specify value to compare
 
     @staticmethod
-    @meta_kw
-    def range(lower, upper, meta=None):
+    def range(meta, lower, upper):
         def f(val):
             upper_expr = ir.BinaryExpr(
                 meta,
@@ -172,9 +172,10 @@ class CompileTransformer(Transformer):
                 upper
             )
 
+            # Both bounds compare the same value, the atom can be shared
             lower_expr = ir.BinaryExpr(
                 meta,
-                ir.Atom("SUIT_POINTS", meta, ir.Suit(meta, "@")),
+                val,
                 ">=",
                 lower
             )
@@ -190,8 +191,7 @@ class CompileTransformer(Transformer):
         return f
 
     @staticmethod
-    @meta_kw
-    def or_fewer(upper, meta=None):
+    def or_fewer(meta, upper):
         def f(val):
             upper_expr = ir.BinaryExpr(
                 meta,
@@ -204,8 +204,7 @@ class CompileTransformer(Transformer):
         return f
 
     @staticmethod
-    @meta_kw
-    def or_more(lower, meta=None):
+    def or_more(meta, lower):
         def f(val):
             lower_expr = ir.BinaryExpr(
                 meta,
@@ -218,8 +217,7 @@ class CompileTransformer(Transformer):
         return f
 
     @staticmethod
-    @meta_kw
-    def exact(lower, meta=None):
+    def exact(meta, lower):
         def f(val):
             lower_expr = ir.BinaryExpr(
                 meta,
@@ -232,110 +230,84 @@ class CompileTransformer(Transformer):
         return f
 
     @staticmethod
-    @meta_kw
-    def binary(lhs, op, rhs, meta=None):
-        return LogicSuit.resolve_logical_suits(ir.BinaryExpr(meta, lhs, op, rhs))
+    def binary(meta, lhs, op, rhs):
+        # Operands were resolved when they were built, a logic suit can't appear at this level
+        return ir.BinaryExpr(meta, lhs, str(op), rhs)
 
     @staticmethod
-    @meta_kw
-    def unary(_op, operand, meta=None):
+    def unary(meta, _op, operand):
         # op is always "not" for now
         return ir.Atom("NEG", meta, operand)
 
     @staticmethod
-    @meta_kw
-    def cmp(lhs, op, rhs, meta=None):
-        return LogicSuit.resolve_logical_suits(ir.BinaryExpr(meta, lhs, str(op), rhs))
+    def cmp(meta, lhs, op, rhs):
+        # Operands are atoms, nothing to resolve. Bare logic suits (H|S >= 6) are left unresolved for now
+        if isinstance(lhs, LogicSuit) and isinstance(rhs, LogicSuit):
+            raise NotImplementedError("Only one side of expression can be a logic suit")
+        return ir.BinaryExpr(meta, lhs, str(op), rhs)
 
     @staticmethod
-    @meta_kw
-    def count_expr(range_gen, suit, meta=None):
-        return LogicSuit.resolve_logical_suits(range_gen(ir.Atom("SUIT_CARDS", meta, suit)))
+    def count_expr(meta, range_gen, suit):
+        expr = range_gen(ir.Atom("SUIT_CARDS", meta, suit))
+        if isinstance(suit, LogicSuit):
+            return LogicSuit.resolve_logical_suits(expr)
+        return expr
 
     @staticmethod
-    @meta_kw
-    def and_suit(lhs, rhs, meta=None):
+    def and_suit(meta, lhs, rhs):
         return LogicSuit("and", lhs, rhs, meta=meta)
 
     @staticmethod
-    @meta_kw
-    def or_suit(lhs, rhs, meta=None):
+    def or_suit(meta, lhs, rhs):
         return LogicSuit("or", lhs, rhs, meta=meta)
 
     @staticmethod
-    @meta_kw
-    def and_op(meta=None):
-        return "and"
-
-    @staticmethod
-    @meta_kw
-    def or_op(meta=None):
-        return "or"
-
-    @staticmethod
-    @meta_kw
-    def prioritized(*args, meta=None):
+    def prioritized(meta, *args):
         *conditions, priority = args
         head, *tail = conditions
-        return Condition(
-            reduce(lambda acc, x: ir.BinaryExpr(meta, acc, "and", x), tail, head),
-            priority,
-            meta
-        )
+        expr = head
+        for cond in tail:
+            expr = ir.BinaryExpr(meta, expr, "and", cond)
+        return Condition(expr, priority, meta)
 
     @staticmethod
-    @meta_kw
-    def unprioritized(*args, meta=None):
+    def unprioritized(meta, *args):
         head, *tail = args
-        return Condition(
-            reduce(lambda acc, x: ir.BinaryExpr(meta, acc, "and", x), tail, head),
-            None,
-            meta
-        )
+        expr = head
+        for cond in tail:
+            expr = ir.BinaryExpr(meta, expr, "and", cond)
+        return Condition(expr, None, meta)
 
     @staticmethod
-    @meta_kw
-    def bid_body(*args, meta=None):
+    def bid_body(meta, *args):
         return args
 
     @staticmethod
-    @meta_kw
-    def bid_level(*args, meta=None):
+    def bid_level(meta, *args):
         return Bid(*args, meta)
 
     @staticmethod
-    @meta_kw
-    def bid_def(child, meta=None):
-        return child
-
-    @staticmethod
-    @meta_kw
-    def bid(*args, meta=None):
+    def bid(meta, *args):
         return BidExpression(*args, meta=meta)
 
     @staticmethod
-    @meta_kw
-    def opening(meta=None):
-        return BidHistory([], meta)
+    def opening(meta):
+        return BidHistory((), meta)
 
     @staticmethod
-    @meta_kw
-    def continuation(*children, meta=None):
+    def continuation(meta, *children):
         return BidHistory(children, meta=None)
 
     @staticmethod
-    @meta_kw
-    def branch_body(*children, meta=None):
+    def branch_body(meta, *children):
         return children
 
     @staticmethod
-    @meta_kw
-    def branch(history, bid_expressions, meta=None):
+    def branch(meta, history, bid_expressions):
         return Branch(history, bid_expressions, meta)
 
     @staticmethod
-    @meta_kw
-    def start(*children, meta=None):
+    def start(meta, *children):
         return children
 
     trump_suit = ir.Suit
@@ -345,25 +317,32 @@ class CompileTransformer(Transformer):
     variable = partial(ir.Atom, "VAR")
 
 
-placeholder = object()
-
-
-def _find(iterable, predicate, default=placeholder):
-    for el in iterable:
-        if predicate(el):
-            return el
-    if default is not placeholder:
-        return default
-    raise ValueError("No item matched the supplied predicate")
-
+def build_branch(
+        branch: Branch,
+        rest: List[Branch],
+        _cache: Optional[Dict[int, List[ir.Branch]]] = None,
+        _by_prefix: Optional[Dict[Tuple[Bid, ...], Branch]] = None
+) -> List[ir.Branch]:
+    # The same branch can be reached through several continuations, compile it only once
+    if _cache is None:
+        _cache = {}
+    key = id(branch)
+    if key in _cache:
+        return _cache[key]
+
+    if _by_prefix is None:
+        _by_prefix = {}
+        for b in rest:
+            # First definition of a sequence wins
+            _by_prefix.setdefault(b.prefix.sequence, b)
 
-def build_branch(branch: Branch, rest: List[Branch]) -> List[ir.Branch]:
     continuation_dict = {}
+    sequence = branch.prefix.sequence
 
     for continuation_bid in branch.continuations:
-        continuation_branch = _find(rest, lambda b: b.prefix == branch.prefix + continuation_bid.prefix, None)
+        continuation_branch = _by_prefix.get(sequence + (continuation_bid.prefix,))
         if continuation_branch is not None:
-            compiled = build_branch(continuation_branch, rest)
+            compiled = build_branch(continuation_branch, rest, _cache, _by_prefix)
             continuation_dict[continuation_bid.prefix] = compiled
         else:
             continuation_dict[continuation_bid.prefix] = []
@@ -381,13 +360,18 @@ def build_branch(branch: Branch, rest: List[Branch]) -> List[ir.Branch]:
         )
         result.append(new_branch)
 
+    _cache[key] = result
     return result
 
 
 if __name__ == '__main__':
+    # prettyprinter is a dev dependency, only needed for this debug output
+    import prettyprinter
+    from prettyprinter import pprint
+    prettyprinter.install_extras(['dataclasses'])
+
     test = open('../blas.ol2').read()
 
     tree = parser.parse(test)
     res = CompileTransformer().transform(tree)
-    from prettyprinter import pprint
     pprint(build_branch(res[0], res))
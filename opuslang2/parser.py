@@ -5,5 +5,6 @@ from pathlib import Path
 _current_path = Path(__file__).resolve()
 _grammar_fname = _current_path.parent.joinpath("opuslang2.lark")
 
+# Remaining shift/reduce conflicts resolve as shift, which is the intended parse. To list them:
 # parser = Lark.open(_grammar_fname, parser='lalr', debug=True)
-parser = Lark.open(_grammar_fname, parser='earley', propagate_positions=True)
+parser = Lark.open(_grammar_fname, parser='lalr', propagate_positions=True)
@@ -0,0 +1,103 @@
+from opus.lang import ir
+
+from opuslang2.compile import BidHistory, CompileTransformer, LogicSuit, build_branch, _POINTS_SUIT
+from opuslang2.parser import parser
+
+
+def _compile(source):
+    return CompileTransformer().transform(parser.parse(source))
+
+
+def test_bid_history_contains():
+    history = BidHistory.from_str("1C-1D-1H")
+
+    prefix_cases = [
+        ("1C", True),
+        ("1C-1D", True),
+        ("1C-1D-1H", True),
+        ("1D", False),
+        ("1C-1H", False),
+        ("1C-1D-1H-1S", False),
+    ]
+    for case, expected in prefix_cases:
+        assert (case in history) == expected
+        assert (BidHistory.from_str(case) in history) == expected
+
+
+def test_long_condition_chain():
+    # Deep enough to exceed the default recursion limit with a recursive transformer
+    chain = " and ".join(["$a >= 1"] * 3000)
+    branch = _compile("open {\n 1C {\n %s\n }\n}\n" % chain)
+
+    condition, = branch.continuations[0].conditions
+    depth = 0
+    expr = condition.expr
+    while expr.op == "and":
+        expr = expr.lhs
+        depth += 1
+    assert depth == 2999
+
+
+def test_build_branch_links_continuations():
+    source = """
+open {
+    1C {
+        12-14
+    }
+}
+
+1C {
+    1D {
+        5+
+    }
+}
+
+1C {
+    1H {
+        6+
+    }
+}
+"""
+    branches = _compile(source)
+    one_club, = build_branch(branches[0], branches)
+
+    # Continuation is looked up by its bid sequence, first definition of a sequence wins
+    one_diamond, = one_club.children
+    assert one_diamond.test.op == ">="
+    assert one_diamond.test.rhs == 5
+    assert one_diamond.children == []
+
+
+def _first_condition(test):
+    branch = _compile("open {\n 1C {\n %s\n }\n}\n" % test)
+    return branch.continuations[0].conditions[0].expr
+
+
+def test_count_range_bounds():
+    expr = _first_condition("2-3 H")
+    assert expr.op == "and"
+    lower, upper = expr.lhs, expr.rhs
+    assert (lower.op, lower.rhs) == (">=", 2)
+    assert (upper.op, upper.rhs) == ("<=", 3)
+    # Both bounds test the same card count atom, not points
+    assert lower.lhs is upper.lhs
+    assert lower.lhs.child is not _POINTS_SUIT
+
+    # With a logic suit both bounds are expanded into one comparison per suit
+    expr = _first_condition("2-3 H|S")
+    assert expr.op == "and"
+    assert expr.lhs.op == "or"
+    assert expr.rhs.op == "or"
+    assert {expr.lhs.lhs.op, expr.lhs.rhs.op} == {">="}
+    assert {expr.rhs.lhs.op, expr.rhs.rhs.op} == {"<="}
+
+
+def test_resolve_logic_suit_on_rhs():
+    hearts, spades = ir.Suit(None, "H"), ir.Suit(None, "S")
+    cards = ir.Atom("SUIT_CARDS", None, LogicSuit("or", hearts, spades, None))
+
+    expr = LogicSuit.resolve_logical_suits(ir.BinaryExpr(None, 4, "<=", cards))
+    assert expr.op == "or"
+    for variant, suit in [(expr.lhs, hearts), (expr.rhs, spades)]:
+        assert (variant.lhs, variant.op) == (4, "<=")
+        assert variant.rhs is suit
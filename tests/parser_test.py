@@ -1,6 +1,7 @@
 from opuslang2 import parser
 from lark import Tree, Token
-import hypothesis
+from hypothesis import given
+from hypothesis.extra.lark import from_lark
 
 
 def test_condition():
@@ -25,6 +26,29 @@ def test_condition():
         assert tree == expected
 
 
-@hypothesis.extra.lark(parser)
+@given(from_lark(parser))
 def test_everything(s):
     tree = parser.parse(s)
+
+
+def test_logic_precedence():
+    def cmp(name, value):
+        return Tree("cmp", [Tree("variable", [Token("NAME", name)]), Token("MORETHAN", ">"), Token("NUMBER", value)])
+
+    def binary(lhs, op, rhs):
+        return Tree("binary", [lhs, Token(op.upper(), op), rhs])
+
+    a, b, c = cmp("a", "1"), cmp("b", "2"), cmp("c", "3")
+    cases = [
+        # and binds tighter than or
+        ("$a > 1 or $b > 2 and $c > 3", binary(a, "or", binary(b, "and", c))),
+        ("$a > 1 and $b > 2 or $c > 3", binary(binary(a, "and", b), "or", c)),
+        # same operator associates to the left
+        ("$a > 1 and $b > 2 and $c > 3", binary(binary(a, "and", b), "and", c)),
+        ("$a > 1 or $b > 2 or $c > 3", binary(binary(a, "or", b), "or", c)),
+        ("($a > 1 or $b > 2) and $c > 3", binary(binary(a, "or", b), "and", c)),
+    ]
+    for case, expected in cases:
+        tree = parser.parse("open {\n 1C {\n %s\n }\n}\n" % case)
+        condition, = next(tree.find_data("unprioritized")).children
+        assert condition == expected